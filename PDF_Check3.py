@@ -1,9 +1,9 @@
 import streamlit as st
-from PyPDF2 import PdfReader
 import fitz  # PyMuPDF
+import gc
+import html
 import io
 from PIL import Image
-import pikepdf
 
 # === Printer Specs ===
 PRINTER_WIDTH = 8.5       # inches
@@ -86,92 +86,98 @@ uploaded_files = st.file_uploader(
 )
 
 def color_box(message, type="success"):
-    if type == "success":
-        st.markdown(f'<div class="success-box">{message}</div>', unsafe_allow_html=True)
-    elif type == "warning":
-        st.markdown(f'<div class="warning-box">{message}</div>', unsafe_allow_html=True)
-    elif type == "error":
-        st.markdown(f'<div class="error-box">{message}</div>', unsafe_allow_html=True)
+    """HTML for one result box; analyze_pdf() sends a file's boxes in one go."""
+    return f'<div class="{type}-box">{message}</div>'
 
 def analyze_pdf(pdf_file):
-    st.markdown(f"---\n### 📄 File: {pdf_file.name}")
-    pdf_data = pdf_file.read()
-    pdf_stream = io.BytesIO(pdf_data)
+    # Same cleanup as UPS_File_Check.analyze_pdf(), which explains it
+    try:
+        with fitz.open(stream=pdf_file.getvalue(), filetype="pdf") as doc:
+            check_pdf(pdf_file.name, doc)
+    finally:
+        fitz.TOOLS.store_shrink(100)
+        gc.collect()
+
+def check_pdf(name, doc):
+    # Everything below goes out as HTML; escape what comes from the upload
+    parts = [f"<hr><h3>📄 File: {html.escape(name)}</h3>"]
 
     # --- Basic PDF info ---
-    reader = PdfReader(pdf_stream)
-    num_pages = len(reader.pages)
-    st.write(f"**Number of pages:** {num_pages}")
+    num_pages = len(doc)
+    parts.append(f"<p><b>Number of pages:</b> {num_pages}</p>")
     
-    first_page = reader.pages[0]
-    width = float(first_page.mediabox.width) / 72
-    height = float(first_page.mediabox.height) / 72
-    st.write(f"**Page size:** {width:.2f}\" × {height:.2f}\"")
+    first_page = doc[0]
+    width = first_page.rect.width / 72
+    height = first_page.rect.height / 72
+    parts.append(f"<p><b>Page size:</b> {width:.2f}\" × {height:.2f}\"</p>")
 
     # --- Page size validation ---
     if abs(width - PRINTER_WIDTH) < 0.01 and abs(height - PRINTER_HEIGHT) < 0.01:
-        color_box(f"✅ Page size matches {PRINTER_WIDTH}×{PRINTER_HEIGHT} inches (Letter).", "success")
+        parts.append(color_box(f"✅ Page size matches {PRINTER_WIDTH}×{PRINTER_HEIGHT} inches (Letter).", "success"))
     else:
-        color_box(f"⚠️ Page size does not match Letter size ({PRINTER_WIDTH}×{PRINTER_HEIGHT}).", "warning")
+        parts.append(color_box(f"⚠️ Page size does not match Letter size ({PRINTER_WIDTH}×{PRINTER_HEIGHT}).", "warning"))
 
     # --- Image DPI check ---
-    doc = fitz.open(stream=pdf_data, filetype="pdf")
     low_res_images = []
     all_dpi = []
+    dpi_by_xref = {}  # images reused across pages are only extracted once
 
     for page_index in range(len(doc)):
         for img in doc.get_page_images(page_index):
             xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            image = Image.open(io.BytesIO(image_bytes))
-            dpi = image.info.get("dpi", (72, 72))
+            if xref not in dpi_by_xref:
+                # Header DPI via PIL (no decode); extract_image's xres/yres are always 96
+                base_image = doc.extract_image(xref)
+                image = Image.open(io.BytesIO(base_image["image"]))
+                dpi_by_xref[xref] = image.info.get("dpi", (72, 72))
+            dpi = dpi_by_xref[xref]
             all_dpi.append(dpi[0])
             if dpi[0] < MIN_DPI or dpi[1] < MIN_DPI:
                 low_res_images.append((page_index+1, dpi[0], dpi[1]))
+                break  # one low-res image is enough to flag the page
 
-    st.subheader("🖼️ Image Resolution Check")
+    parts.append("<h4>🖼️ Image Resolution Check</h4>")
     if low_res_images:
-        for img_info in low_res_images:
-            color_box(f"⚠️ Page {img_info[0]}: {img_info[1]}×{img_info[2]} DPI", "warning")
+        parts.append(
+            f'<div class="warning-box">⚠️ Images below {MIN_DPI} DPI:<ul>'
+            + "".join(f"<li>Page {page}: {x}×{y} DPI</li>" for page, x, y in low_res_images)
+            + "</ul></div>"
+        )
     else:
         if all_dpi:
-            color_box(f"✅ All images meet the minimum {MIN_DPI} DPI requirement.", "success")
+            parts.append(color_box(f"✅ All images meet the minimum {MIN_DPI} DPI requirement.", "success"))
         else:
-            st.info("ℹ️ No images found in this PDF.")
+            parts.append("<p>ℹ️ No images found in this PDF.</p>")
 
     # --- Color mode check ---
-    st.subheader("🎨 Color Mode Validation")
+    parts.append("<h4>🎨 Color Mode Validation</h4>")
     try:
-        pdf = pikepdf.open(io.BytesIO(pdf_data))
+        # Named /ColorSpace of every image the pages draw; get_images()
+        # leaves out soft masks (always DeviceGray) and unused images
         color_spaces = set()
-        for page in pdf.pages:
-            resources = page.get("/Resources", {})
-            xobjects = resources.get("/XObject", {})
-            for obj_name in xobjects:
-                obj = xobjects[obj_name]
-                try:
-                    cs = obj["/ColorSpace"]
-                    if isinstance(cs, pikepdf.Name):
-                        color_spaces.add(str(cs))
-                except Exception:
-                    pass
+        image_xrefs = {img[0] for page in doc for img in page.get_images(full=True)}
+        for xref in image_xrefs:
+            kind, cs = doc.xref_get_key(xref, "ColorSpace")
+            if kind == "name":
+                color_spaces.add(cs.lstrip("/"))
 
         if color_spaces:
-            st.write("Detected color spaces:", ", ".join(color_spaces))
+            parts.append(f"<p>Detected color spaces: {html.escape(', '.join(color_spaces))}</p>")
             invalid_colors = [c for c in color_spaces if c not in ACCEPTED_COLOR]
             if invalid_colors:
-                for c in invalid_colors:
-                    color_box(f"⚠️ Unsupported color mode detected: {c}", "warning")
+                parts.extend(
+                    color_box(f"⚠️ Unsupported color mode detected: {html.escape(c)}", "warning")
+                    for c in invalid_colors
+                )
             else:
-                color_box("✅ All color modes are valid (CMYK or RGB).", "success")
+                parts.append(color_box("✅ All color modes are valid (CMYK or RGB).", "success"))
         else:
-            st.info("ℹ️ No color space info found (PDF may be text-only or grayscale).")
+            parts.append("<p>ℹ️ No color space info found (PDF may be text-only or grayscale).</p>")
     except Exception as e:
-        color_box(f"Error checking color: {e}", "error")
+        parts.append(color_box(f"Error checking color: {html.escape(str(e))}", "error"))
 
     # --- Overall validation summary ---
-    st.subheader("📋 Overall Validation Summary")
+    parts.append("<h4>📋 Overall Validation Summary</h4>")
     passed = True
     if not (abs(width - PRINTER_WIDTH) < 0.01 and abs(height - PRINTER_HEIGHT) < 0.01):
         passed = False
@@ -182,9 +188,12 @@ def analyze_pdf(pdf_file):
             passed = False
 
     if passed:
-        color_box("✅ PDF meets all printer specifications.", "success")
+        parts.append(color_box("✅ PDF meets all printer specifications.", "success"))
     else:
-        color_box("⚠️ PDF does NOT meet one or more printer specifications.", "error")
+        parts.append(color_box("⚠️ PDF does NOT meet one or more printer specifications.", "error"))
+
+    # One payload per file instead of one frontend element per line
+    st.html("".join(parts))
 
 # Analyze all uploaded files
 if uploaded_files:
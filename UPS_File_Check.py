@@ -1,85 +1,133 @@
 import streamlit as st
-from PyPDF2 import PdfReader
 import fitz  # PyMuPDF
+import gc
+import html
 import io
+import math
+import re
 from PIL import Image
-import pikepdf
 
 # ===============================================================
 # SIZE MATCHING
 # ===============================================================
-def size_matches(actual_w, actual_h, accepted_sizes, tolerance=0.05):
-    """Check if (w, h) matches any accepted size in any orientation."""
-    for (aw, ah) in accepted_sizes:
-        # Normal orientation
-        if abs(actual_w - aw) <= tolerance and abs(actual_h - ah) <= tolerance:
-            return True
-        # Rotated orientation
-        if abs(actual_w - ah) <= tolerance and abs(actual_h - aw) <= tolerance:
-            return True
-    return False
-
 ACCEPTED_SIZES = [
     (4.00, 6.00),
     (5.00, 7.00),
     (8.00, 10.00),
 ]
 
+SIZE_TOLERANCE = 0.05  # inches, either way
+
+# Buckets are 2 * SIZE_TOLERANCE wide and centred on the accepted sizes
+# (all multiples of 0.1"), so landing in a size's bucket means being
+# within tolerance of it. (short, long) ordering covers both orientations.
+_BUCKET = 2 * SIZE_TOLERANCE
+ACCEPTED_BUCKETS = {
+    (round(min(w, h) / _BUCKET), round(max(w, h) / _BUCKET))
+    for w, h in ACCEPTED_SIZES
+}
+
+def size_matches(actual_w, actual_h):
+    """Check if (w, h) matches any accepted size in any orientation."""
+    short, long = sorted((actual_w, actual_h))
+    return (round(short / _BUCKET), round(long / _BUCKET)) in ACCEPTED_BUCKETS
+
 MIN_DPI = 300
+# Skip the DPI/color/safe-zone checks for PDFs already rejected on size
+FAST_REJECT = True
+# Upload extensions routed to analyze_pdf(); the rest go to analyze_image()
+PDF_EXTS = {"pdf"}
 SAFE_MARGIN_INCH = 0.125  # 1/8 inch
+SAFE_MARGIN_PTS = SAFE_MARGIN_INCH * 72  # = 9 pt
 ACCEPTED_COLOR = ["DeviceCMYK", "DeviceRGB", "CMYK", "RGB"]
 
-# === Branding Colors (UPS-style) ===
-PRIMARY_COLOR = "#FFB500"
-SECONDARY_COLOR = "#3C3C3C"
-SUCCESS_COLOR = "#66FF66"
-WARNING_COLOR = "#FFA500"
-ERROR_COLOR = "#FF5555"
+def _safe_rect(width, height):
+    return fitz.Rect(
+        SAFE_MARGIN_PTS,
+        SAFE_MARGIN_PTS,
+        width - SAFE_MARGIN_PTS,
+        height - SAFE_MARGIN_PTS,
+    )
+
+# Safe zones of the accepted sizes in both orientations, keyed on the page
+# size in points; pages off by a fraction of a point fall back to _safe_rect()
+SAFE_RECTS = {
+    (w * 72, h * 72): _safe_rect(w * 72, h * 72)
+    for short, long in ACCEPTED_SIZES
+    for w, h in ((short, long), (long, short))
+}
+
+# One bit per color space; names for the same space share a bit
+_CS_BITS = {
+    "DeviceCMYK": 1, "CMYK": 1,
+    "DeviceRGB": 2, "RGB": 2,
+    "DeviceGray": 4, "L": 4,
+    "CalRGB": 8,
+    "CalGray": 16,
+    "Lab": 32,
+    "ICCBased": 64,
+    "Indexed": 128, "P": 128,
+    "Separation": 256,
+    "DeviceN": 512,
+}
+# First name listed for each bit, used when reporting
+_CS_NAMES = {bit: name for name, bit in reversed(_CS_BITS.items())}
+_ACCEPTED_MASK = sum({_CS_BITS[c] for c in ACCEPTED_COLOR})
+
+# Content-stream fill/stroke color operators (RGB: rg/RG, CMYK: k/K)
+_COLOR_OP_RE = re.compile(rb"(?:^|\s)(rg|RG|k|K)(?=\s|$)")
 
 # === Page Setup ===
-st.set_page_config(page_title="UPS Store Print File Checker", layout="wide")
-st.markdown(
-    f"""
+# Branding colors (UPS Gold #FFB500 for the header) are written straight
+# into the CSS; this string is their only copy
+_CSS = """
     <style>
-    .stApp {{
+    .stApp {
         background-color: #f7f7f7;
-    }}
-    .header {{
-        color: {PRIMARY_COLOR};
+    }
+    .header {
+        color: #FFB500;
         font-size: 2.5rem;
         font-weight: bold;
-    }}
-    .instructions {{
+    }
+    .instructions {
         background-color: #FFF3CD;
         padding: 10px;
         border-radius: 8px;
         margin-bottom: 20px;
-    }}
-    .success-box {{
+    }
+    .success-box {
         background-color: #D4EDDA;
         padding: 8px;
         border-radius: 5px;
         margin-bottom: 5px;
-    }}
-    .warning-box {{
+    }
+    .warning-box {
         background-color: #FFF3CD;
         padding: 8px;
         border-radius: 5px;
         margin-bottom: 5px;
-    }}
-    .error-box {{
+    }
+    .error-box {
         background-color: #F8D7DA;
         padding: 8px;
         border-radius: 5px;
         margin-bottom: 5px;
-    }}
+    }
     </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
+
+st.set_page_config(page_title="UPS Store Print File Checker", layout="wide")
+st.markdown(_CSS, unsafe_allow_html=True)
 
 # === Logo ===
-st.image("UPS_Logo.png", width=150)
+@st.cache_resource
+def load_logo():
+    """Read the logo once per server process instead of on every rerun."""
+    with open("UPS_Logo.png", "rb") as f:
+        return f.read()
+
+st.image(load_logo(), width=150)
 st.markdown('<div class="header">UPS Store Print File Checker 🖨️</div>', unsafe_allow_html=True)
 
 st.markdown(
@@ -102,53 +150,119 @@ uploaded_files = st.file_uploader(
 # COLOR DETECTION HELPERS
 # =====================================================================
 
-def detect_default_color_space(pdf):
+def detect_default_color_space(doc):
     try:
-        root = pdf.root
-        if "/DefaultRGB" in root:
+        root = doc.pdf_catalog()
+        if doc.xref_get_key(root, "DefaultRGB")[0] != "null":
             return "RGB"
-        if "/DefaultCMYK" in root:
+        if doc.xref_get_key(root, "DefaultCMYK")[0] != "null":
             return "CMYK"
     except:
         pass
     return None
 
+def color_space_bit(name, unknown):
+    """Return the _CS_BITS bit for a name; unrecognized names go to `unknown`."""
+    bit = _CS_BITS.get(name.lstrip("/"), 0)
+    if not bit:
+        unknown.add(name)
+    return bit
+
+def detect_color_from_xobjects(doc, unknown):
+    """Fold the named /ColorSpace of every image the pages draw into a bitmask.
+
+    page.get_images() also lists images nested inside form XObjects, but
+    not soft masks (always DeviceGray) or images no page uses. An image
+    shared by many pages is looked up once.
+    """
+    bits = 0
+    seen = set()
+    for page in doc:
+        for img in page.get_images(full=True):
+            xref = img[0]
+            if xref in seen:
+                continue
+            seen.add(xref)
+            kind, cs = doc.xref_get_key(xref, "ColorSpace")
+            if kind == "name":
+                bits |= color_space_bit(cs, unknown)
+    return bits
+
 def detect_color_from_streams(doc):
     try:
+        seen = set()
         for page in doc:
-            text = page.get_text("text")
-            if " rg" in text or " RG" in text:
-                return "RGB"
-            if " k" in text or " K" in text:
-                return "CMYK"
+            # Operators live in the raw content streams, not the extracted
+            # text. Scan each stream on its own (no page-level concatenation)
+            # and only once, even when pages share it.
+            for xref in page.get_contents():
+                if xref in seen:
+                    continue
+                seen.add(xref)
+                if m := _COLOR_OP_RE.search(doc.xref_stream(xref)):
+                    return "RGB" if m.group(1) in (b"rg", b"RG") else "CMYK"
     except:
         pass
     return None
 
-def detect_color_from_images(doc):
-    modes = set()
-    try:
-        for page in doc:
-            for img in page.get_images(full=True):
-                xref = img[0]
-                base = doc.extract_image(xref)
-                pil_img = Image.open(io.BytesIO(base["image"]))
-                modes.add(pil_img.mode)
-    except:
-        pass
-    return modes
+# =====================================================================
+# EMBEDDED IMAGE SCAN
+# =====================================================================
+
+# MuPDF colorspace component count -> PIL-style mode name
+IMAGE_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+
+def scan_images(doc):
+    """Return (page_number, dpi, mode) for every image placement in the PDF.
+
+    DPI is the effective print resolution: pixel size divided by the size
+    the image is drawn at on the page. Both come from MuPDF's image
+    metadata, so nothing is extracted or decoded. Placements with no pixel
+    size or a zero-area transform cannot print and are skipped.
+    """
+    placements = []
+    for i, page in enumerate(doc):
+        for info in page.get_image_info():
+            # transform maps the unit square onto the page, so its column
+            # lengths are the drawn width/height in points (rotation-safe)
+            a, b, c, d, _, _ = info["transform"]
+            drawn_w = math.hypot(a, b) / 72
+            drawn_h = math.hypot(c, d) / 72
+            if not (info["width"] and info["height"] and drawn_w and drawn_h):
+                continue
+            dpi = (round(info["width"] / drawn_w), round(info["height"] / drawn_h))
+            mode = IMAGE_MODES.get(info["colorspace"], info["cs-name"])
+            placements.append((i + 1, dpi, mode))
+    return placements
 
 # =====================================================================
-# DISPLAY COLOR BOXES
+# DISPLAY RESULTS
 # =====================================================================
 
-def color_box(message, type="success"):
-    if type == "success":
-        st.markdown(f'<div class="success-box">{message}</div>', unsafe_allow_html=True)
-    elif type == "warning":
-        st.markdown(f'<div class="warning-box">{message}</div>', unsafe_allow_html=True)
-    elif type == "error":
-        st.markdown(f'<div class="error-box">{message}</div>', unsafe_allow_html=True)
+# HTML template for each result level the analyzers emit
+_HTML = {
+    "header": "<hr><h3>{}</h3>",
+    "subheader": "<h4>{}</h4>",
+    "text": "<p>{}</p>",
+    "success": '<div class="success-box">{}</div>',
+    "warning": '<div class="warning-box">{}</div>',
+    "error": '<div class="error-box">{}</div>',
+}
+
+def bullet_list(items):
+    """Format items as one HTML list, so a whole category fits in one box."""
+    return "<ul>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>"
+
+def render_results(results):
+    """Draw (level, message) pairs produced by the analyzers.
+
+    Analyzers never touch Streamlit directly; everything is drawn here. A
+    file's results go out as a single st.html payload inside their own container,
+    so messages are HTML and the analyzers escape anything taken from the
+    upload (file names, PDF text, color space names).
+    """
+    with st.container():
+        st.html("".join(_HTML[level].format(message) for level, message in results))
 
 # =====================================================================
 # SAFE ZONE CHECK (TEXT ONLY)
@@ -157,20 +271,19 @@ def color_box(message, type="success"):
 def check_margin_text_only(page):
     """Check if any text crosses 1/8 inch margin from page edge."""
     issues = []
-    margin_pts = SAFE_MARGIN_INCH * 72
-    safe_rect = fitz.Rect(
-        margin_pts,
-        margin_pts,
-        page.rect.width - margin_pts,
-        page.rect.height - margin_pts,
-    )
+    page_rect = page.rect  # built anew on every access; read once
+    size = (page_rect.width, page_rect.height)
+    safe_rect = SAFE_RECTS.get(size) or _safe_rect(*size)
 
-    # Text blocks only
+    # Text blocks only (block type 0). The default flags already leave
+    # image blocks out, the type test is only a guard.
     for block in page.get_text("blocks"):
-        x0, y0, x1, y1, text = block[:5]
+        x0, y0, x1, y1, text, _, block_type = block[:7]
+        if block_type != 0:
+            continue
         block_rect = fitz.Rect(x0, y0, x1, y1)
         if not safe_rect.contains(block_rect):
-            issues.append(f"Text too close to edge: '{text[:30]}...'")
+            issues.append(f"Text too close to edge: '{html.escape(text[:30])}...'")
 
     return issues
 
@@ -178,127 +291,164 @@ def check_margin_text_only(page):
 # PDF ANALYSIS
 # =====================================================================
 
-def analyze_pdf(file):
-    st.markdown(f"---\n### 📄 File: {file.name}")
-
-    pdf_data = file.read()
-    pdf_stream = io.BytesIO(pdf_data)
-    reader = PdfReader(pdf_stream)
-    doc = fitz.open(stream=pdf_data, filetype="pdf")
+# Streamlit reruns the whole script on every interaction; the analyzers are
+# pure functions of (name, bytes), so cache them on a hash of the content.
+@st.cache_data(max_entries=64, show_spinner=False)
+def analyze_pdf(name, pdf_data):
+    """Run every PDF check and return the results as (level, message) pairs."""
+    try:
+        # Parse once; every check reuses this handle. fitz reads the bytes
+        # in place, and they are held in memory anyway as the cache key.
+        with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+            return check_pdf(name, doc)
+    finally:
+        # MuPDF's store outlives the document; without this a long-running
+        # server keeps every upload's fonts and images cached
+        fitz.TOOLS.store_shrink(100)
+        gc.collect()
+
+def check_pdf(name, doc):
+    """Run the PDF checks against an already-open fitz document."""
+    results = [("header", f"📄 File: {html.escape(name)}")]
 
     # Page size
-    first_page = reader.pages[0]
-    width_in = float(first_page.mediabox.width) / 72
-    height_in = float(first_page.mediabox.height) / 72
-    st.write(f"**Page size:** {width_in:.2f} × {height_in:.2f} inches")
+    first_page = doc[0]
+    width_in = first_page.rect.width / 72
+    height_in = first_page.rect.height / 72
+    results.append(("text", f"<b>Page size:</b> {width_in:.2f} × {height_in:.2f} inches"))
 
-    if size_matches(width_in, height_in, ACCEPTED_SIZES):
-        color_box("✅ Page size matches accepted print sizes.", "success")
+    if size_matches(width_in, height_in):
+        results.append(("success", "✅ Page size matches accepted print sizes."))
     else:
-        color_box("⚠️ Page size does not match 4×6, 5×7, or 8×10.", "warning")
+        results.append(("warning", "⚠️ Page size does not match 4×6, 5×7, or 8×10."))
+        if FAST_REJECT:
+            results.append(("text", "Other checks skipped: fix the page size and re-upload."))
+            return results
 
     # Image DPI
-    st.subheader("🖼️ Image Resolution Check")
-    low_res = []
-    for i, page in enumerate(doc):
-        for img in page.get_images(full=True):
-            xref = img[0]
-            base = doc.extract_image(xref)
-            pil_img = Image.open(io.BytesIO(base["image"]))
-            dpi = pil_img.info.get("dpi", (72, 72))
-            if dpi[0] < MIN_DPI or dpi[1] < MIN_DPI:
-                low_res.append((i + 1, dpi))
+    results.append(("subheader", "🖼️ Image Resolution Check"))
+    images = scan_images(doc)
+    # Report per page: the first low-res image on a page is enough
+    low_res = {}
+    for page_num, dpi, _ in images:
+        if page_num not in low_res and (dpi[0] < MIN_DPI or dpi[1] < MIN_DPI):
+            low_res[page_num] = dpi
 
     if low_res:
-        for page_num, dpi in low_res:
-            color_box(f"⚠️ Page {page_num}: {dpi[0]}×{dpi[1]} DPI (below 300)", "warning")
+        results.append(("warning", "⚠️ Images below 300 DPI:" + bullet_list(
+            f"Page {page_num}: {dpi[0]}×{dpi[1]} DPI" for page_num, dpi in low_res.items()
+        )))
     else:
-        color_box("✅ All images meet the 300 DPI minimum.", "success")
+        results.append(("success", "✅ All images meet the 300 DPI minimum."))
 
     # Color mode check
-    st.subheader("🎨 Color Mode Check")
+    results.append(("subheader", "🎨 Color Mode Check"))
     try:
-        pdf = pikepdf.open(io.BytesIO(pdf_data))
-        color_spaces = set()
-
-        for page in pdf.pages:
-            res = page.get("/Resources", {})
-            xobjs = res.get("/XObject", {})
-            for obj in xobjs:
-                cs = xobjs[obj].get("/ColorSpace")
-                if cs and isinstance(cs, pikepdf.Name):
-                    color_spaces.add(str(cs))
-
-        default_cs = detect_default_color_space(pdf)
+        unknown = set()
+        bits = detect_color_from_xobjects(doc, unknown)
+
+        default_cs = detect_default_color_space(doc)
         if default_cs:
-            color_spaces.add(default_cs)
+            bits |= color_space_bit(default_cs, unknown)
 
-        stream_cs = detect_color_from_streams(doc)
-        if stream_cs:
-            color_spaces.add(stream_cs)
+        # The operator scan can only ever report RGB or CMYK; skip it
+        # when both are already known.
+        if bits & _ACCEPTED_MASK != _ACCEPTED_MASK:
+            stream_cs = detect_color_from_streams(doc)
+            if stream_cs:
+                bits |= color_space_bit(stream_cs, unknown)
 
-        img_modes = detect_color_from_images(doc)
-        if img_modes:
-            color_spaces.update(img_modes)
+        for mode in {mode for _, _, mode in images}:
+            bits |= color_space_bit(mode, unknown)
 
-        # Strip leading '/' for validation
-        invalid = [c for c in color_spaces if c.lstrip("/") not in ACCEPTED_COLOR]
+        rejected = bits & ~_ACCEPTED_MASK
+        invalid = [name for bit, name in sorted(_CS_NAMES.items()) if rejected & bit]
+        invalid.extend(sorted(unknown))
         if invalid:
-            color_box(f"⚠️ Unsupported color space(s): {', '.join(invalid)}", "warning")
+            results.append(("warning", f"⚠️ Unsupported color space(s): {html.escape(', '.join(invalid))}"))
         else:
-            color_box("✅ All colors are CMYK or RGB.", "success")
+            results.append(("success", "✅ All colors are CMYK or RGB."))
     except Exception as e:
-        color_box(f"Error checking color: {e}", "error")
+        results.append(("error", f"Error checking color: {html.escape(str(e))}"))
 
     # Safe zone check (text only)
-    st.subheader("📐 Safe Zone Check (1/8\")")
+    results.append(("subheader", "📐 Safe Zone Check (1/8\")"))
     issues = []
     for i, page in enumerate(doc, start=1):
         issues.extend(check_margin_text_only(page))
 
     if issues:
-        for issue in issues:
-            color_box(f"⚠️ {issue}", "warning")
+        results.append(("warning", "⚠️ Text within 1/8\" of page edge:" + bullet_list(issues)))
     else:
-        color_box("✅ No text within 1/8\" of page edge.", "success")
+        results.append(("success", "✅ No text within 1/8\" of page edge."))
+
+    return results
 
 # =====================================================================
 # IMAGE ANALYSIS
 # =====================================================================
 
-def analyze_image(file):
-    st.markdown(f"---\n### 🖼️ File: {file.name}")
-
-    img = Image.open(file)
-    dpi = img.info.get("dpi", (72, 72))
-    width_px, height_px = img.size
+# EXIF tags: XResolution, YResolution, ResolutionUnit (2 = inch, 3 = cm)
+_EXIF_XRES, _EXIF_YRES, _EXIF_RES_UNIT = 0x011A, 0x011B, 0x0128
+
+def image_dpi(img):
+    """DPI from the image header, falling back to EXIF (e.g. Photoshop JPEGs).
+
+    Pillow may hand back IFDRational values, which turn width / dpi into a
+    Fraction that f-string float formatting rejects; return plain floats.
+    """
+    dpi = img.info.get("dpi")
+    if dpi:
+        return float(dpi[0]), float(dpi[1])
+    exif = img.getexif()
+    x, y = exif.get(_EXIF_XRES), exif.get(_EXIF_YRES)
+    if x and y:
+        scale = 2.54 if exif.get(_EXIF_RES_UNIT) == 3 else 1
+        return float(x) * scale, float(y) * scale
+    return (72.0, 72.0)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def analyze_image(name, image_data):
+    """Run every image check and return the results as (level, message) pairs."""
+    results = [("header", f"🖼️ File: {html.escape(name)}")]
+
+    # Header only: size, mode and DPI never need the pixels decoded
+    with Image.open(io.BytesIO(image_data)) as img:
+        width_px, height_px = img.size
+        mode = img.mode
+        dpi = image_dpi(img)
     width_in = width_px / dpi[0]
     height_in = height_px / dpi[1]
 
-    color_box(f"Image size: {width_in:.2f} × {height_in:.2f} inches at {dpi[0]} DPI", "success")
+    results.append(("success", f"Image size: {width_in:.2f} × {height_in:.2f} inches at {dpi[0]:.0f} DPI"))
 
-    if size_matches(width_in, height_in, ACCEPTED_SIZES):
-        color_box("✅ Matches accepted print size.", "success")
+    if size_matches(width_in, height_in):
+        results.append(("success", "✅ Matches accepted print size."))
     else:
-        color_box("⚠️ Size not 4×6, 5×7, or 8×10.", "warning")
+        results.append(("warning", "⚠️ Size not 4×6, 5×7, or 8×10."))
 
     if dpi[0] < MIN_DPI or dpi[1] < MIN_DPI:
-        color_box("⚠️ Low image resolution (<300 DPI).", "warning")
+        results.append(("warning", "⚠️ Low image resolution (<300 DPI)."))
     else:
-        color_box("✅ DPI meets minimum requirement.", "success")
+        results.append(("success", "✅ DPI meets minimum requirement."))
 
-    if img.mode in ["RGB", "CMYK"]:
-        color_box(f"✅ Color mode: {img.mode}", "success")
+    if mode in ["RGB", "CMYK"]:
+        results.append(("success", f"✅ Color mode: {mode}"))
     else:
-        color_box(f"⚠️ Unusual color mode: {img.mode}", "warning")
+        results.append(("warning", f"⚠️ Unusual color mode: {mode}"))
+
+    return results
 
 # =====================================================================
 # PROCESS FILES
 # =====================================================================
 
 if uploaded_files:
+    # One file at a time on the script thread: PyMuPDF does not support
+    # threads, and repeat uploads are served from st.cache_data anyway
     for f in uploaded_files:
-        if f.name.lower().endswith(".pdf"):
-            analyze_pdf(f)
-        else:
-            analyze_image(f)
+        ext = f.name.rsplit(".", 1)[-1].lower()
+        analyzer = analyze_pdf if ext in PDF_EXTS else analyze_image
+        # getvalue() returns UploadedFile's own buffer without copying;
+        # the bytes are also what st.cache_data hashes for the cache key
+        render_results(analyzer(f.name, f.getvalue()))